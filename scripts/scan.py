@@ -7,15 +7,20 @@ Script to run the Cargo Scan tool on a single crate or a list of crates.
 """
 
 import argparse
+import collections
+import concurrent.futures
 import csv
 import logging
 import os
+import queue
+import shutil
 import subprocess
 import sys
+import threading
 
 # ===== Check requirements =====
 
-MIN_PYTHON = (3, 0)
+MIN_PYTHON = (3, 9)
 if sys.version_info < MIN_PYTHON:
     version = f"{MIN_PYTHON[0]}.{MIN_PYTHON[1]}"
     found = f"{sys.version_info.major}.{sys.version_info.minor}"
@@ -42,13 +47,65 @@ CARGO_SCAN_ADD_ARGS = ["-e"]
 CARGO_SCAN_CSV_HEADER = "crate, fn_decl, callee, effect, dir, file, line, col"
 CARGO_SCAN_METADATA_HEADER = "total, loc_lb, loc_ub, macros, loc_lb, loc_ub, conditional_code, loc_lb, loc_ub, skipped_calls, loc_lb, loc_ub, skipped_fn_ptrs, loc_lb, loc_ub, skipped_other, loc_lb, loc_ub, unsafe_trait, loc_lb, loc_ub, unsafe_impl, loc_lb, loc_ub, pub_fns, pub_fns_with_effects, pub_total_effects"
 
-check_installed(RUSTC)
-check_installed(CARGO)
-check_installed(CARGO_SCAN)
-check_installed(CARGO_DOWNLOAD, check_exit_code=False)
+# Effect lines are kept as bytes until they are written out
+CARGO_SCAN_CSV_HEADER_BYTES = CARGO_SCAN_CSV_HEADER.encode("utf-8")
+CARGO_SCAN_METADATA_HEADER_BYTES = CARGO_SCAN_METADATA_HEADER.encode("utf-8")
+
+# Records that the dependency checks passed for the currently installed tools
+CACHE_DIR = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+DEPS_CACHE = os.path.join(CACHE_DIR, "cargo-scan", "deps_ok")
+
+def deps_fingerprint():
+    # Path, mtime and size of each checked tool; cargo download is the
+    # cargo-download binary on the PATH
+    tools = [RUSTC[0], CARGO[0], "cargo-" + CARGO_DOWNLOAD[1]]
+    paths = [shutil.which(tool) or tool for tool in tools] + [os.path.abspath(CARGO_SCAN[0])]
+    parts = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            parts.append(f"{path} {st.st_mtime_ns} {st.st_size}")
+        except OSError:
+            parts.append(f"{path} missing")
+    return "\n".join(parts)
+
+def deps_cached(fingerprint):
+    try:
+        with open(DEPS_CACHE) as fh:
+            return fh.read() == fingerprint
+    except OSError:
+        return False
+
+def cache_deps(fingerprint):
+    try:
+        os.makedirs(os.path.dirname(DEPS_CACHE), exist_ok=True)
+        with open(DEPS_CACHE, 'w') as fh:
+            fh.write(fingerprint)
+    except OSError:
+        pass
+
+def check_dependencies():
+    # Skip the checks if they already passed with the same installed tools
+    fingerprint = deps_fingerprint()
+    if deps_cached(fingerprint):
+        return
+
+    # Run the checks concurrently to overlap their process startup
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        checks = [
+            executor.submit(check_installed, RUSTC),
+            executor.submit(check_installed, CARGO),
+            executor.submit(check_installed, CARGO_SCAN),
+            executor.submit(check_installed, CARGO_DOWNLOAD, check_exit_code=False),
+        ]
+        for check in checks:
+            check.result()
+
+    cache_deps(fingerprint)
+
+check_dependencies()
 
 # Unchecked dependencies
-CP = ["cp"]
 OPEN = ["open"]
 
 # ===== Additional constants =====
@@ -56,6 +113,11 @@ OPEN = ["open"]
 # Number of progress tracking messages to display
 PROGRESS_INCS = 10
 
+# Read buffer size for cargo-scan output
+SCAN_BUFSIZE = 1 << 20
+# Write buffer size for results files
+RESULTS_BUFSIZE = 1 << 20
+
 # Source lists
 CRATES_DIR = "data/packages"
 TEST_CRATES_DIR = "data/test-packages"
@@ -75,20 +137,10 @@ logging.addLevelName(logging.WARNING, "\033[0;33m%s\033[0;0m" % "WARNING")
 logging.addLevelName(logging.ERROR, "\033[0;31m%s\033[0;0m" % "ERROR")
 
 def copy_file(src, dst):
-    subprocess.run(CP + [src, dst], check=True)
-
-def make_path(dir, prefix, suffix):
-    return os.path.join(dir, f"{prefix}{suffix}")
+    shutil.copyfile(src, dst)
 
 # ===== Crate lists and cargo download =====
 
-def count_lines(cratefile, header_row=True):
-    with open(cratefile, 'r') as fh:
-        result = len(fh.readlines())
-        if header_row:
-            result -= 1
-        return result
-
 def get_crate_names(cratefile):
     crates = []
     with open(cratefile, newline='') as infile:
@@ -99,86 +151,128 @@ def get_crate_names(cratefile):
                 crates.append(row[0])
     return crates
 
-def download_crate(crates_dir, crate, test_run):
-    target = os.path.join(crates_dir, crate)
-    if os.path.exists(target):
-        logging.debug(f"Found existing crate: {target}")
+def list_existing_crates(crates_dir):
+    if not os.path.isdir(crates_dir):
+        return set()
+    with os.scandir(crates_dir) as entries:
+        return {entry.name for entry in entries}
+
+def download_crate(crate, crate_dir, test_run, existing):
+    if crate in existing:
+        logging.debug(f"Found existing crate: {crate_dir}")
     else:
         if test_run:
-            logging.warning(f"Crate not found during test run: {target}")
+            logging.warning(f"Crate not found during test run: {crate_dir}")
         else:
-            logging.info(f"Downloading crate: {target}")
-            subprocess.run(CARGO_DOWNLOAD + ["-x", crate, "-o", target], check=True)
+            logging.info(f"Downloading crate: {crate_dir}")
+            subprocess.run(CARGO_DOWNLOAD + ["-x", crate, "-o", crate_dir], check=True)
+            # crate lists may name a crate more than once
+            existing.add(crate)
 
 def sort_summary_dict(d):
     return sorted(d.items(), key=lambda x: x[1], reverse=True)
 
 def make_pattern_summary(pattern_summary):
-    result = ""
-    result += "===== Patterns =====\n"
-    result += "Total instances of each effect pattern:\n"
-    pattern_sorted = sort_summary_dict(pattern_summary)
-    for p, n in pattern_sorted:
-        result += f"{p}: {n}\n"
-    return result
+    parts = ["===== Patterns =====", "Total instances of each effect pattern:"]
+    for p, n in sort_summary_dict(pattern_summary):
+        parts.append(f"{p}: {n}")
+    return "\n".join(parts) + "\n"
 
 def make_crate_summary(crate_summary):
-    result = ""
-    result += "===== Crate Summary =====\n"
-    result += "Number of effects by crate:\n"
-    crate_sorted = sort_summary_dict(crate_summary)
+    parts = ["===== Crate Summary =====", "Number of effects by crate:"]
     num_nonzero = 0
     num_zero = 0
-    for c, n in crate_sorted:
+    for c, n in sort_summary_dict(crate_summary):
         if n > 0:
             num_nonzero += 1
-            result += f"{c}: {n}\n"
+            parts.append(f"{c}: {n}")
         else:
             num_zero += 1
-    result += "===== Crate Totals =====\n"
-    result += f"{num_nonzero} crates with 1 or more effects\n"
-    result += f"{num_zero} crates with 0 effects\n"
-    return result
+    parts.append("===== Crate Totals =====")
+    parts.append(f"{num_nonzero} crates with 1 or more effects")
+    parts.append(f"{num_zero} crates with 0 effects")
+    return "\n".join(parts) + "\n"
 
 def make_metadata_csv(metadata_summary):
-    result = f"crate, {CARGO_SCAN_METADATA_HEADER}\n"
-    metadata_sorted = sort_summary_dict(metadata_summary)
-    for k, m in metadata_sorted:
-        result += f"{k}, {m}\n"
-    return result
+    parts = [f"crate, {CARGO_SCAN_METADATA_HEADER}"]
+    # Values are CSV strings, so sorting them is not meaningful; keep crate order
+    for k, m in metadata_summary.items():
+        parts.append(f"{k}, {m}")
+    return "\n".join(parts) + "\n"
 
 # ===== Syn backend =====
 
+# Output of a single cargo-scan run; iterating yields the effect CSV lines (as bytes)
+class ScanResult:
+    def __init__(self, effects, patterns, metadata):
+        self.effects = effects
+        self.patterns = patterns
+        self.metadata = metadata
+
+    def __iter__(self):
+        return iter(self.effects)
+
 def scan_crate(crate, crate_dir):
-    logging.debug(f"Scanning crate: {crate}")
+    logging.debug("Scanning crate: %s", crate)
     command = CARGO_SCAN + [crate_dir] + CARGO_SCAN_ADD_ARGS
-    logging.debug(f"Running: {command}")
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    logging.debug("Running: %s", command)
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=SCAN_BUFSIZE)
 
-    stdout_lines = map(lambda x: x.strip().decode("utf-8"), iter(proc.stdout.readline, b""))
+    # drain stderr in the background so the child can't block on a full pipe
+    stderr_reader = threading.Thread(target=proc.stderr.read, daemon=True)
+    stderr_reader.start()
+
+    stdout_lines = (line.strip() for line in proc.stdout)
     effects = []
+    patterns = collections.Counter()
 
     # read header row
     hdr = next(stdout_lines)
-    assert hdr == CARGO_SCAN_CSV_HEADER, f"Unexpected header row from scan: {hdr}"
+    assert hdr == CARGO_SCAN_CSV_HEADER_BYTES, f"Unexpected header row from scan: {hdr}"
 
     # read effect CSV lines
     for effect_csv in stdout_lines:
-        if effect_csv == "":
+        if effect_csv == b"":
             break
         else:
-            effect_pat = effect_csv.split(", ")[3]
-            effects.append((effect_pat, effect_csv))
+            effects.append(effect_csv)
+            patterns[effect_csv.split(b", ", 4)[3]] += 1
 
     # read metadata
     hdr = next(stdout_lines)
-    assert hdr == CARGO_SCAN_METADATA_HEADER, f"Unexpected metadata header from scan: {hdr}"
-
-    metadata = next(stdout_lines)
-    for _ in stdout_lines:
-        assert False, "Unexpected extra output from scan"
-
-    return effects, metadata
+    assert hdr == CARGO_SCAN_METADATA_HEADER_BYTES, f"Unexpected metadata header from scan: {hdr}"
+
+    metadata = next(stdout_lines).decode("utf-8")
+    leftover = proc.stdout.read()
+    assert leftover == b"", f"Unexpected extra output from scan: {leftover!r}"
+
+    # reap the child and release its pipes now rather than at garbage collection
+    proc.stdout.close()
+    stderr_reader.join()
+    proc.stderr.close()
+    rc = proc.wait()
+    assert rc == 0, f"Scan exited with status {rc} for crate: {crate}"
+
+    # only the distinct pattern names need decoding
+    patterns = collections.Counter({p.decode("utf-8"): n for p, n in patterns.items()})
+    return ScanResult(effects, patterns, metadata)
+
+def download_and_scan(crates_dir, crates, test_run, executor, ready):
+    # Downloads run one at a time, in crate order, to avoid contention between
+    # cargo-download runs; each crate's scan is submitted as soon as it is
+    # available so that downloads overlap with scanning. Any failure is passed
+    # to the main thread in place of a scan; None marks the end of the crates.
+    crate = None
+    try:
+        existing = list_existing_crates(crates_dir)
+        for crate in crates:
+            crate_dir = os.path.join(crates_dir, crate)
+            download_crate(crate, crate_dir, test_run, existing)
+            ready.put((crate, executor.submit(scan_crate, crate, crate_dir)))
+    except BaseException as e:
+        ready.put((crate, e))
+        return
+    ready.put(None)
 
 # ===== Entrypoint =====
 
@@ -190,16 +284,22 @@ def main():
     parser.add_argument('-t', '--test-run', action="store_true", help=f"Test run: use existing crates in {TEST_CRATES_DIR} instead of downloading via cargo-download")
     parser.add_argument('-o', '--output-prefix', help="Output file prefix to save results")
     parser.add_argument('-s', '--std', action="store_true", help="Flag standard library imports only")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="Number of crates to scan in parallel (default: number of CPUs)")
     parser.add_argument('-v', '--verbose', action="count", help="Verbosity level: v=err, vv=warning, vvv=info, vvvv=debug, vvvvv=trace (default: info)", default=0)
 
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     if args.verbose > 5:
         logging.error("verbosity only goes up to 4 (-vvvv)")
         sys.exit(1)
     log_level = [logging.INFO, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][args.verbose]
     logging.basicConfig(level=log_level)
     logging.debug(args)
+    # Checked once up front so per-effect logging costs nothing on normal runs
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
     if args.test_run:
         logging.info("=== Test run ===")
@@ -212,8 +312,8 @@ def main():
         crates = [args.crate]
         crates_infostr = f"{args.crate}"
     else:
-        num_crates = count_lines(args.infile)
         crates = get_crate_names(args.infile)
+        num_crates = len(crates)
         crates_infostr = f"{num_crates} crates from {args.infile}"
 
     if args.output_prefix is None and num_crates > 1:
@@ -221,34 +321,71 @@ def main():
 
     logging.info(f"=== Scanning {crates_infostr} in {crates_dir} ===")
 
-    results = []
     crate_summary = {c: 0 for c in crates}
-    pattern_summary = {}
+    pattern_summary = collections.Counter()
     metadata_summary = {c: "" for c in crates}
     progress_inc = num_crates // PROGRESS_INCS
 
-    for i, crate in enumerate(crates):
-        if progress_inc > 0 and i > 0 and i % progress_inc == 0:
-            progress = 100 * i // num_crates
-            logging.info(f"{progress}% complete")
+    # Effects are written to the results file as each crate completes rather
+    # than held in memory until the end of the run. They go to a temporary
+    # file that only replaces the previous results if the run succeeds.
+    results_fh = None
+    if args.output_prefix is not None:
+        results_prefix = os.path.join(RESULTS_DIR, args.output_prefix)
+        results_path = results_prefix + RESULTS_ALL_SUFFIX
+        results_tmp_path = results_path + ".tmp"
+        logging.info(f"Saving all results to {results_path}")
+        results_fh = open(results_tmp_path, 'wb', buffering=RESULTS_BUFSIZE)
+        results_fh.write(CARGO_SCAN_CSV_HEADER_BYTES + b'\n')
+
+    # Scan crates in parallel; the work happens in cargo-scan child processes,
+    # so threads suffice. A background thread downloads crates and queues up
+    # their scans; results are consumed in crate order so that the summaries
+    # and output files are deterministic.
+    ready = queue.Queue(maxsize=2 * args.jobs)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    downloader = threading.Thread(
+        target=download_and_scan,
+        args=(crates_dir, crates, args.test_run, executor, ready),
+        daemon=True,
+    )
+    downloader.start()
+    try:
+        for i, (crate, scanned) in enumerate(iter(ready.get, None)):
+            if isinstance(scanned, subprocess.CalledProcessError):
+                logging.error(f"cargo-download failed for crate: {crate} ({scanned})")
+                sys.exit(1)
+            elif isinstance(scanned, BaseException):
+                raise scanned
+            result = scanned.result()
+
+            if progress_inc > 0 and i > 0 and i % progress_inc == 0:
+                progress = 100 * i // num_crates
+                logging.info(f"{progress}% complete")
+
+            if debug:
+                for eff_csv in result:
+                    logging.debug("effect found: %s", eff_csv.decode('utf-8'))
+            if results_fh is not None:
+                results_fh.writelines(eff_csv + b'\n' for eff_csv in result)
 
-        try:
-            download_crate(crates_dir, crate, args.test_run)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"cargo-download failed for crate: {crate} ({e})")
-            sys.exit(1)
-
-        crate_dir = os.path.join(crates_dir, crate)
-        effects, metadata = scan_crate(crate, crate_dir)
-        for eff_pat, eff_csv in effects:
-            logging.debug(f"effect found: {eff_csv}")
-            results.append(eff_csv)
             # Update summaries
-            crate_summary[crate] += 1
-            pattern_summary.setdefault(eff_pat, 0)
-            pattern_summary[eff_pat] += 1
-
-        metadata_summary[crate] = metadata
+            crate_summary[crate] += len(result.effects)
+            pattern_summary.update(result.patterns)
+            metadata_summary[crate] = result.metadata
+    except BaseException:
+        # Cancel scans that haven't started yet rather than running them all
+        # before reporting the error; the downloader stops once submit fails
+        executor.shutdown(wait=True, cancel_futures=True)
+        if results_fh is not None:
+            results_fh.close()
+            os.remove(results_tmp_path)
+        raise
+    executor.shutdown()
+
+    if results_fh is not None:
+        results_fh.close()
+        os.replace(results_tmp_path, results_path)
 
     # Sanity check
     if sum(crate_summary.values()) != sum(pattern_summary.values()):
@@ -263,32 +400,24 @@ def main():
     else:
         logging.info(f"=== Saving results ===")
 
-        prefix = args.output_prefix
-        results_path = make_path(RESULTS_DIR, prefix, RESULTS_ALL_SUFFIX)
-        pattern_path = make_path(RESULTS_DIR, prefix, RESULTS_PATTERN_SUFFIX)
-        summary_path = make_path(RESULTS_DIR, prefix, RESULTS_SUMMARY_SUFFIX)
-        metadata_path = make_path(RESULTS_DIR, prefix, RESULTS_METADATA_SUFFIX)
+        pattern_path = results_prefix + RESULTS_PATTERN_SUFFIX
+        summary_path = results_prefix + RESULTS_SUMMARY_SUFFIX
+        metadata_path = results_prefix + RESULTS_METADATA_SUFFIX
 
         pat_str = make_pattern_summary(pattern_summary)
         crate_str = make_crate_summary(crate_summary)
         metadata_str = make_metadata_csv(metadata_summary)
 
-        logging.info(f"Saving all results to {results_path}")
-        with open(results_path, 'w') as fh:
-            fh.write(CARGO_SCAN_CSV_HEADER + '\n')
-            for eff_csv in results:
-                fh.write(eff_csv + '\n')
-
         logging.info(f"Saving pattern totals to {pattern_path}")
-        with open(pattern_path, 'w') as fh:
+        with open(pattern_path, 'w', buffering=RESULTS_BUFSIZE) as fh:
             fh.write(pat_str)
 
         logging.info(f"Saving summary to {summary_path}")
-        with open(summary_path, 'w') as fh:
+        with open(summary_path, 'w', buffering=RESULTS_BUFSIZE) as fh:
             fh.write(crate_str)
 
         logging.info(f"Saving metadata to {metadata_path}")
-        with open(metadata_path, 'w') as fh:
+        with open(metadata_path, 'w', buffering=RESULTS_BUFSIZE) as fh:
             fh.write(metadata_str)
 
 if __name__ == "__main__":